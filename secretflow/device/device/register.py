@@ -75,9 +75,10 @@ class Registrar:
         Returns:
             Kernel execution result.
         """
-        if name not in self._ops[device_type]:
+        op = self._ops[device_type].get(name)
+        if op is None:
             raise KeyError(f'device: {device_type}, op: {name} not registered')
-        return self._ops[device_type][name](*args, **kwargs)
+        return op(*args, **kwargs)
 
 
 _registrar = Registrar()
@@ -12,8 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import functools
-import json
 import logging
 import os
 import struct
@@ -22,22 +22,30 @@ import sys
 import tempfile
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import Enum, unique
-from typing import Any, Callable, Dict, Iterable, List, Sequence, Tuple, Union
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import fed
 import jax
-import jax.numpy as jnp
 import numpy as np
-import pandas as pd
 import ray
 import spu
 import spu.libspu.link as spu_link
 import spu.libspu.logging as spu_logging
 import spu.utils.frontend as spu_fe
 from google.protobuf import json_format
-from heu import phe
 from spu import pir, psi, spu_pb2
 from spu.utils.distributed import dtype_spu_to_np, shape_spu_to_np
 
@@ -50,16 +58,48 @@ from .pyu import PYUObject
 from .register import dispatch
 from .type_traits import spu_datatype_to_heu, spu_fxp_size
 
-_LINK_DESC_NAMES = [
-    'connect_retry_times',
-    'connect_retry_interval_ms',
-    'recv_timeout_ms',
-    'http_max_payload_size',
-    'http_timeout_ms',
-    'throttle_window_size',
-    'brpc_channel_protocol',
-    'brpc_channel_connection_type',
-]
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Column of row ids appended to the csv written by psi_df/psi_join_df.
+_PSI_ROW_ID_COLUMN = '__psi_row_id__'
+
+# Plaintext types which are always a single pytree leaf.
+_PLAINTEXT_LEAF_TYPES = (np.ndarray, np.generic, int, float, complex)
+
+# Types of a single share of an SPU value.
+_SHARE_LEAF_TYPES = (bytes, np.ndarray)
+
+# Number of released SPUObjects to accumulate before deleting their shares.
+_DEL_SHARES_BATCH_SIZE = 64
+
+# Header of a frame exchanged by psi_join_csv: (is last frame, payload size).
+# Keep the native '?i' layout so that peers of older releases could parse it.
+_PSI_FRAME_HEADER = struct.Struct('?i')
+# Frame which ends the exchange, with a 1 byte dummy payload.
+_PSI_LAST_FRAME = _PSI_FRAME_HEADER.pack(True, 1) + b'\x00'
+# Max payload size of a frame exchanged by psi_join_csv.
+_PSI_FRAME_MAX_PAYLOAD_SIZE = 1 << 20
+# Max number of threads joining chunks in psi_join_csv. Every thread holds up to
+# two chunks of the input, so this bounds memory rather than following the
+# host's core count.
+_PSI_JOIN_MAX_WORKERS = 4
+
+# Packet sent by pir server to tell client it is ready.
+_PIR_SYNC_PACKET = struct.pack('?is', True, 1, b'\x00')
+
+_LINK_DESC_NAMES = frozenset(
+    [
+        'connect_retry_times',
+        'connect_retry_interval_ms',
+        'recv_timeout_ms',
+        'http_max_payload_size',
+        'http_timeout_ms',
+        'throttle_window_size',
+        'brpc_channel_protocol',
+        'brpc_channel_connection_type',
+    ]
+)
 
 
 def _fill_link_ssl_opts(tls_opts: Dict, link_ssl_opts: spu_link.SSLOptions):
@@ -82,14 +122,14 @@ def _fill_link_desc_attrs(link_desc: Dict, tls_opts: Dict, desc: spu_link.Desc):
             if name not in _LINK_DESC_NAMES:
                 raise InvalidArgumentError(
                     f'Unsupported param {name} in link desc, '
-                    f'{_LINK_DESC_NAMES} are now available only.'
+                    f'{sorted(_LINK_DESC_NAMES)} are now available only.'
                 )
             setattr(desc, name, value)
 
-    if not link_desc or 'recv_timeout_ms' not in link_desc.keys():
+    if not link_desc or 'recv_timeout_ms' not in link_desc:
         # set default timeout 120s
         desc.recv_timeout_ms = 120 * 1000
-    if not link_desc or 'http_timeout_ms' not in link_desc.keys():
+    if not link_desc or 'http_timeout_ms' not in link_desc:
         # set default timeout 120s
         desc.http_timeout_ms = 120 * 1000
 
@@ -112,13 +152,74 @@ def _plaintext_to_numpy(data: Any) -> np.ndarray:
     """
 
     # NOTE(junfeng): jnp.asarray would transfer int64s to int32s.
-    return np.asarray(jnp.asarray(data))
+    # Apply the same dtype canonicalization without a round trip through a
+    # jax device array.
+    data = np.asarray(data)
+    dtype = jax.dtypes.canonicalize_dtype(data.dtype)
+    if dtype != data.dtype:
+        data = data.astype(dtype)
+    return data
+
+
+def _fxp_content_to_ndarray(content: bytes, size: int) -> np.ndarray:
+    """decode SPU fixed-point ring elements into signed integers.
+
+    Args:
+        content (bytes): raw content of a ValueProto, in native byteorder.
+        size (int): bytes of each element.
+
+    Returns:
+        np.ndarray: a flat array, dtype is object if elements exceed int64.
+    """
+    if size in (4, 8):
+        return np.frombuffer(content, dtype=f'i{size}')
+    elif size == 16:
+        halves = np.frombuffer(content, dtype=np.uint64).reshape(-1, 2)
+        if sys.byteorder == 'little':
+            lo, hi = halves[:, 0], halves[:, 1]
+        else:
+            hi, lo = halves[:, 0], halves[:, 1]
+        return (hi.view(np.int64).astype(object) << 64) | lo.astype(object)
+    else:
+        # sign-extend every element to a multiple of 8 bytes in little endian,
+        # then combine the 64-bit limbs.
+        rows = np.frombuffer(content, dtype=np.uint8).reshape(-1, size)
+        if sys.byteorder == 'big':
+            rows = rows[:, ::-1]
+        padded = np.empty((rows.shape[0], -(-size // 8) * 8), dtype=np.uint8)
+        padded[:, :size] = rows
+        padded[:, size:] = np.where(rows[:, -1:] & 0x80, 0xFF, 0x00)
+        limbs = padded.view('<u8')
+        if limbs.shape[1] == 1:
+            return limbs[:, 0].view('<i8').astype(np.int64)
+        value = limbs[:, -1].view('<i8').astype(object)
+        for i in range(limbs.shape[1] - 2, -1, -1):
+            value = (value << 64) | limbs[:, i].astype(object)
+        return value
+
+
+def _share_to_bytes(share: Union[bytes, np.ndarray]) -> bytes:
+    """shares produced by SPUIO are uint8 ndarrays so that ray could transfer
+    them without pickling, while spu.Io and spu.Runtime only accept bytes.
+    """
+    if isinstance(share, np.ndarray):
+        return share.tobytes()
+    return share
 
 
 @dataclass
 class SPUValueMeta:
     """The metadata of an SPU value, which is a Numpy array or equivalent."""
 
+    __slots__ = (
+        'shape',
+        'dtype',
+        'vtype',
+        'protocol',
+        'field',
+        'fxp_fraction_bits',
+    )
+
     shape: Sequence[int]
     dtype: np.dtype
     vtype: spu.Visibility
@@ -128,6 +229,14 @@ class SPUValueMeta:
     field: spu_pb2.FieldType
     fxp_fraction_bits: int
 
+    def __setstate__(self, state):
+        # state is a (None, slots) tuple, or a plain dict for metas pickled
+        # before __slots__ was introduced.
+        if isinstance(state, tuple):
+            state = state[1]
+        for name, value in state.items():
+            setattr(self, name, value)
+
 
 class SPUObject(DeviceObject):
     def __init__(
@@ -165,14 +274,20 @@ class SPUObject(DeviceObject):
     def __del__(self):
         if hasattr(self, "shares_name"):
             assert len(self.shares_name) == len(self.device.actors)
-            for i, actor in enumerate(self.device.actors.values()):
-                try:
-                    actor.del_share.remote(self.shares_name[i])
-                except TypeError:
-                    # Python doesn't make any guarantees about when __del__ is called,
-                    # actor may not exist, been GCed before this function called.
-                    # This may happened when Host(Driver) progress exit.
-                    pass
+            # shares are released in batches, see SPU.del_shares.
+            self.device.del_shares(self.shares_name)
+
+
+@functools.lru_cache(maxsize=8)
+def _get_spu_io(runtime_config: bytes, world_size: int) -> spu.Io:
+    """spu.Io is reused across SPUIO instances with the same config, since
+    SPUIO is created at every reveal and PYU to SPU transfer.
+
+    Args:
+        runtime_config (bytes): serialized RuntimeConfig.
+        world_size (int): world_size of SPU device.
+    """
+    return spu.Io(world_size, spu.RuntimeConfig.FromString(runtime_config))
 
 
 class SPUIO:
@@ -185,7 +300,10 @@ class SPUIO:
         """
         self.runtime_config = runtime_config
         self.world_size = world_size
-        self.io = spu.Io(self.world_size, self.runtime_config)
+        self.io = _get_spu_io(
+            self.runtime_config.SerializeToString(deterministic=True),
+            self.world_size,
+        )
 
     def make_shares(self, data: Any, vtype: spu.Visibility) -> Tuple[Any, List[Any]]:
         """Convert a Python object to meta and shares of an SPUObject.
@@ -197,32 +315,45 @@ class SPUIO:
         Returns:
             Tuple[Any, List[Any]]: meta and shares of an SPUObject
         """
+        if isinstance(data, _PLAINTEXT_LEAF_TYPES):
+            # fast path for a single value, skip pytree flatten/unflatten.
+            return self._make_leaf_shares(data, vtype)
+
         flatten_value, tree = jax.tree_util.tree_flatten(data)
-        flatten_shares = []
-        flatten_meta = []
 
         if len(flatten_value) == 0:
             return data, *[[] for _ in range(self.world_size)]  # noqa e999
 
-        for val in flatten_value:
-            val = _plaintext_to_numpy(val)
-            flatten_meta.append(
-                SPUValueMeta(
-                    val.shape,
-                    val.dtype,
-                    vtype,
-                    self.runtime_config.protocol,
-                    self.runtime_config.field,
-                    self.runtime_config.fxp_fraction_bits,
-                )
-            )
-            flatten_shares.append(self.io.make_shares(val, vtype))
+        flatten_meta = [None] * len(flatten_value)
+        # shares of each party, indexed by leaf.
+        flatten_shares = [[None] * len(flatten_value) for _ in range(self.world_size)]
+        for i, val in enumerate(flatten_value):
+            flatten_meta[i], *leaf_shares = self._make_leaf_shares(val, vtype)
+            for party, share in enumerate(leaf_shares):
+                flatten_shares[party][i] = share
 
-        return jax.tree_util.tree_unflatten(tree, flatten_meta), *[  # noqa e999
-            jax.tree_util.tree_unflatten(tree, list(shares))
-            for shares in list(zip(*flatten_shares))
+        return tree.unflatten(flatten_meta), *[  # noqa e999
+            tree.unflatten(shares) for shares in flatten_shares
         ]
 
+    def _make_leaf_shares(self, val: Any, vtype: spu.Visibility) -> Tuple[Any, ...]:
+        val = _plaintext_to_numpy(val)
+        meta = SPUValueMeta(
+            val.shape,
+            val.dtype,
+            vtype,
+            self.runtime_config.protocol,
+            self.runtime_config.field,
+            self.runtime_config.fxp_fraction_bits,
+        )
+        return (
+            meta,
+            *(
+                np.frombuffer(share, dtype=np.uint8)
+                for share in self.io.make_shares(val, vtype)
+            ),
+        )
+
     def reconstruct(self, shares: List[Any], meta: Any = None) -> Any:
         """Convert shares of an SPUObject to the origin Python object.
 
@@ -235,22 +366,27 @@ class SPUIO:
         """
         assert len(shares) == self.world_size
         if meta:
-            flatten_metas, _ = jax.tree_util.tree_flatten(meta)
-            for m in flatten_metas:
+            for m in jax.tree_util.tree_leaves(meta):
                 assert m.protocol == self.runtime_config.protocol
                 assert m.field == self.runtime_config.field
                 assert m.fxp_fraction_bits == self.runtime_config.fxp_fraction_bits
-        _, tree = jax.tree_util.tree_flatten(shares[0])
-        flatten_shares = []
-        for share in shares:
-            flatten_share, _ = jax.tree_util.tree_flatten(share)
-            flatten_shares.append(flatten_share)
+
+        if isinstance(shares[0], _SHARE_LEAF_TYPES):
+            # fast path for a single value, skip pytree flatten/unflatten.
+            return self.io.reconstruct([_share_to_bytes(share) for share in shares])
+
+        # shares of all parties share the same tree structure.
+        flatten_share, tree = jax.tree_util.tree_flatten(shares[0])
+        flatten_shares = [flatten_share] + [
+            tree.flatten_up_to(share) for share in shares[1:]
+        ]
 
         flatten_value = [
-            self.io.reconstruct(list(shares)) for shares in list(zip(*flatten_shares))
+            self.io.reconstruct([_share_to_bytes(share) for share in shares])
+            for shares in zip(*flatten_shares)
         ]
 
-        return jax.tree_util.tree_unflatten(tree, flatten_value)
+        return tree.unflatten(flatten_value)
 
 
 @unique
@@ -290,6 +426,9 @@ class SPURuntime:
 
         self.rank = rank
         self.cluster_def = cluster_def
+        self._party_to_rank = {
+            node['party']: i for i, node in enumerate(cluster_def['nodes'])
+        }
 
         desc = spu_link.Desc()
         tls_opts = None
@@ -302,13 +441,25 @@ class SPURuntime:
             desc.add_party(node['party'], address)
         _fill_link_desc_attrs(link_desc=link_desc, tls_opts=tls_opts, desc=desc)
 
+        # a frame of psi join result must fit in a single http message.
+        self.psi_frame_max_payload_size = _PSI_FRAME_MAX_PAYLOAD_SIZE
+        if link_desc and link_desc.get('http_max_payload_size'):
+            self.psi_frame_max_payload_size = min(
+                self.psi_frame_max_payload_size,
+                link_desc['http_max_payload_size'] - _PSI_FRAME_HEADER.size,
+            )
+            assert self.psi_frame_max_payload_size > 0, (
+                'http_max_payload_size shall be greater than '
+                f'{_PSI_FRAME_HEADER.size}, got {link_desc["http_max_payload_size"]}.'
+            )
+
         if use_link:
             self.link = spu_link.create_brpc(desc, rank)
         else:
             self.link = None
 
-        self.conf = json_format.Parse(
-            json.dumps(cluster_def['runtime_config']), spu.RuntimeConfig()
+        self.conf = json_format.ParseDict(
+            cluster_def['runtime_config'], spu.RuntimeConfig()
         )
         self.runtime = spu.Runtime(self.link, self.conf)
         self.share_seq_id = 0
@@ -317,35 +468,46 @@ class SPURuntime:
         self.share_seq_id += 1
         return f"{self.share_seq_id}"
 
+    def get_new_share_names(self, n: int) -> List[str]:
+        start = self.share_seq_id + 1
+        self.share_seq_id += n
+        return [str(i) for i in range(start, start + n)]
+
     def infeed_share(self, val: Any) -> Any:
-        flatten_val, flatten_tree = jax.tree_util.tree_flatten(val)
-        shares_name = []
-        for share in flatten_val:
+        if isinstance(val, _SHARE_LEAF_TYPES):
             name = self.get_new_share_name()
-            self.runtime.set_var(name, share)
-            shares_name.append(name)
+            self.runtime.set_var(name, _share_to_bytes(val))
+            return name
 
-        return jax.tree_util.tree_unflatten(flatten_tree, shares_name)
+        flatten_val, flatten_tree = jax.tree_util.tree_flatten(val)
+        shares_name = self.get_new_share_names(len(flatten_val))
+        for name, share in zip(shares_name, flatten_val):
+            self.runtime.set_var(name, _share_to_bytes(share))
+
+        return flatten_tree.unflatten(shares_name)
 
     def outfeed_share(self, val: Any) -> Any:
+        if isinstance(val, str):
+            return self.runtime.get_var(val)
+
         flatten_names, flatten_tree = jax.tree_util.tree_flatten(val)
-        shares = []
-        for name in flatten_names:
-            shares.append(self.runtime.get_var(name))
+        shares = [self.runtime.get_var(name) for name in flatten_names]
 
-        return jax.tree_util.tree_unflatten(flatten_tree, shares)
+        return flatten_tree.unflatten(shares)
 
     def del_share(self, val: Any):
-        flatten_names, _ = jax.tree_util.tree_flatten(val)
-        for name in flatten_names:
+        # treedef is not needed for deletion, only leaves are.
+        for name in jax.tree_util.tree_leaves(val):
             assert isinstance(name, str)
             self.runtime.del_var(name)
 
+    def del_shares(self, *vals):
+        for val in vals:
+            self.del_share(val)
+
     def dump(self, meta: Any, val: Any, path: str):
-        flatten_names, _ = jax.tree_util.tree_flatten(val)
-        shares = []
-        for name in flatten_names:
-            shares.append(self.runtime.get_var(name).decode("latin1"))
+        # shares are dumped as bytes, pickle stores them as they are.
+        shares = [self.runtime.get_var(name) for name in jax.tree_util.tree_leaves(val)]
 
         import cloudpickle as pickle
 
@@ -361,15 +523,14 @@ class SPURuntime:
         meta = record['meta']
         shares = record['shares']
 
-        shares_name = []
-        for share in shares:
-            name = self.get_new_share_name()
-            self.runtime.set_var(name, share.encode("latin1"))
-            shares_name.append(name)
-
-        _, flatten_tree = jax.tree_util.tree_flatten(meta)
+        shares_name = self.get_new_share_names(len(shares))
+        for name, share in zip(shares_name, shares):
+            if isinstance(share, str):
+                # dumped by previous versions as latin1 decoded str.
+                share = share.encode("latin1")
+            self.runtime.set_var(name, share)
 
-        return meta, jax.tree_util.tree_unflatten(flatten_tree, shares_name)
+        return meta, jax.tree_util.tree_structure(meta).unflatten(shares_name)
 
     def run(
         self,
@@ -389,45 +550,48 @@ class SPURuntime:
             List: first parts are output vars following the exec.output_names. The last item is metadata.
         """
 
-        flatten_names, _ = jax.tree_util.tree_flatten(val)
+        flatten_names = jax.tree_util.tree_leaves(val)
         assert len(executable.input_names) == len(flatten_names)
 
-        executable.input_names[:] = flatten_names
+        del executable.input_names[:]
+        executable.input_names.extend(flatten_names)
 
-        output_names = []
-        for _ in range(len(executable.output_names)):
-            output_names.append(self.get_new_share_name())
+        output_names = self.get_new_share_names(len(executable.output_names))
 
-        executable.output_names[:] = output_names
+        del executable.output_names[:]
+        executable.output_names.extend(output_names)
 
         self.runtime.run(executable)
 
-        metadata = []
-        for name in output_names:
-            meta = self.runtime.get_var_meta(name)
-            metadata.append(
-                SPUValueMeta(
-                    shape_spu_to_np(meta.shape),
-                    dtype_spu_to_np(meta.data_type),
-                    meta.visibility,
-                    self.conf.protocol,
-                    self.conf.field,
-                    self.conf.fxp_fraction_bits,
-                )
+        # spu.Runtime has no batched meta getter, keep the per-output loop
+        # as tight as possible.
+        get_var_meta = self.runtime.get_var_meta
+        protocol, field, fxp_fraction_bits = (
+            self.conf.protocol,
+            self.conf.field,
+            self.conf.fxp_fraction_bits,
+        )
+        metadata = [None] * len(output_names)
+        for i, name in enumerate(output_names):
+            meta = get_var_meta(name)
+            metadata[i] = SPUValueMeta(
+                shape_spu_to_np(meta.shape),
+                dtype_spu_to_np(meta.data_type),
+                meta.visibility,
+                protocol,
+                field,
+                fxp_fraction_bits,
             )
 
+        out_tree = jax.tree_util.tree_structure(out_shape)
+
         if num_returns_policy == SPUCompilerNumReturnsPolicy.SINGLE:
-            _, out_tree = jax.tree_util.tree_flatten(out_shape)
-            return jax.tree_util.tree_unflatten(
-                out_tree, metadata
-            ), jax.tree_util.tree_unflatten(out_tree, output_names)
+            return out_tree.unflatten(metadata), out_tree.unflatten(output_names)
         elif num_returns_policy == SPUCompilerNumReturnsPolicy.FROM_COMPILER:
-            return metadata + output_names
+            return (*metadata, *output_names)
         elif num_returns_policy == SPUCompilerNumReturnsPolicy.FROM_USER:
-            _, out_tree = jax.tree_util.tree_flatten(out_shape)
-            single_meta, single_share = jax.tree_util.tree_unflatten(
-                out_tree, metadata
-            ), jax.tree_util.tree_unflatten(out_tree, output_names)
+            single_meta = out_tree.unflatten(metadata)
+            single_share = out_tree.unflatten(output_names)
 
             if hasattr(single_meta, '__iter__'):
                 return *(single_meta), *(single_share)
@@ -467,24 +631,20 @@ class SPURuntime:
         )
 
         size = spu_fxp_size(self.conf.field)
-        value = BigintNdArray(
-            [
-                int.from_bytes(
-                    value.content[i * size : (i + 1) * size],
-                    sys.byteorder,
-                    signed=True,
-                )
-                for i in range(len(value.content) // size)
-            ],
-            value.shape.dims,
+        value = BigintNdArray.from_ndarray(
+            _fxp_content_to_ndarray(value.content, size).reshape(
+                tuple(value.shape.dims)
+            )
         )
 
+        from heu import phe
+
         return value.to_hnp(encoder=phe.BigintEncoder(schema))
 
     def psi_df(
         self,
         key: Union[str, List[str]],
-        data: pd.DataFrame,
+        data: 'pd.DataFrame',
         receiver: str,
         protocol='KKRT_PSI_2PC',
         precheck_input=True,
@@ -520,15 +680,10 @@ class SPURuntime:
         Returns:
             pd.DataFrame or None: joined DataFrame.
         """
-        # save key dataframe to temp file for streaming psi
-        with tempfile.TemporaryDirectory() as data_dir:
-            input_path, output_path = (
-                f'{data_dir}/psi-input.csv',
-                f'{data_dir}/psi-output.csv',
-            )
-            data.to_csv(input_path, index=False)
-
-            report = self.psi_csv(
+        return self._psi_with_csv(
+            key,
+            data,
+            lambda key, input_path, output_path: self.psi_csv(
                 key,
                 input_path,
                 output_path,
@@ -544,15 +699,59 @@ class SPURuntime:
                 dppsi_bob_sub_sampling,
                 dppsi_epsilon,
                 ic_mode,
+            ),
+        )
+
+    def _psi_with_csv(
+        self,
+        key: Union[str, List[str]],
+        data: 'pd.DataFrame',
+        csv_psi_fn: Callable[[List[str], str, str], Dict],
+    ):
+        """Run a csv based psi on a DataFrame.
+
+        Only key columns and row ids are saved to csv, joined rows are then
+        gathered from the origin DataFrame by row ids, which saves writing
+        and parsing the whole DataFrame.
+
+        Args:
+            key (str, List[str]): Column(s) used to join.
+            data (pd.DataFrame): DataFrame to be joined.
+            csv_psi_fn (Callable): psi on csv file, called with key,
+                input_path and output_path.
+
+        Returns:
+            pd.DataFrame or None: joined DataFrame.
+        """
+        import pandas as pd
+
+        if isinstance(key, str):
+            key = [key]
+        assert (
+            _PSI_ROW_ID_COLUMN not in data.columns
+        ), f'{_PSI_ROW_ID_COLUMN} is reserved and should not be a column name.'
+
+        # save key dataframe to temp file for streaming psi
+        with tempfile.TemporaryDirectory() as data_dir:
+            input_path, output_path = (
+                f'{data_dir}/psi-input.csv',
+                f'{data_dir}/psi-output.csv',
             )
+            data[key].assign(**{_PSI_ROW_ID_COLUMN: np.arange(data.shape[0])}).to_csv(
+                input_path, index=False
+            )
+
+            report = csv_psi_fn(key, input_path, output_path)
 
             if report['intersection_count'] == -1:
                 # can not get result, return None
                 return None
             else:
-                # load result dataframe from temp file
-                return pd.read_csv(output_path)
-            
+                # load result row ids from temp file
+                row_ids = pd.read_csv(output_path, usecols=[_PSI_ROW_ID_COLUMN])
+                return data.iloc[row_ids[_PSI_ROW_ID_COLUMN].to_numpy()].reset_index(
+                    drop=True
+                )
 
     def psi_csv(
         self,
@@ -621,11 +820,7 @@ class SPURuntime:
                 'intersection_count': -1,
             }
 
-        receiver_rank = -1
-        for i, node in enumerate(self.cluster_def['nodes']):
-            if node['party'] == receiver:
-                receiver_rank = i
-                break
+        receiver_rank = self._party_to_rank.get(receiver, -1)
         assert receiver_rank >= 0, f'invalid receiver {receiver}'
 
         config = psi.BucketPsiConfig(
@@ -702,7 +897,7 @@ class SPURuntime:
     def psi_join_df(
         self,
         key: Union[str, List[str]],
-        data: pd.DataFrame,
+        data: 'pd.DataFrame',
         receiver: str,
         join_party: str,
         protocol='KKRT_PSI_2PC',
@@ -731,15 +926,10 @@ class SPURuntime:
         Returns:
             pd.DataFrame or None: joined DataFrame.
         """
-        # save key dataframe to temp file for streaming psi
-        with tempfile.TemporaryDirectory() as data_dir:
-            input_path, output_path = (
-                f'{data_dir}/psi-input.csv',
-                f'{data_dir}/psi-output.csv',
-            )
-            data.to_csv(input_path, index=False)
-
-            report = self.psi_join_csv(
+        return self._psi_with_csv(
+            key,
+            data,
+            lambda key, input_path, output_path: self.psi_join_csv(
                 key,
                 input_path,
                 output_path,
@@ -750,14 +940,8 @@ class SPURuntime:
                 bucket_size,
                 curve_type,
                 ic_mode,
-            )
-
-            if report['intersection_count'] == -1:
-                # can not get result, return None
-                return None
-            else:
-                # load result dataframe from temp file
-                return pd.read_csv(output_path)
+            ),
+        )
 
     def psi_join_csv(
         self,
@@ -804,35 +988,53 @@ class SPURuntime:
             or (protocol == "BC22_PSI_2PC")
         ), f"Unsupported protocol:{protocol}"
 
+        import pandas as pd
+        import pyarrow as pa
+        from pyarrow import csv as pa_csv
+
         if isinstance(key, str):
             key = [key]
 
-        receiver_rank = -1
-        for i, node in enumerate(self.cluster_def['nodes']):
-            if node['party'] == receiver:
-                receiver_rank = i
-                break
+        receiver_rank = self._party_to_rank.get(receiver, -1)
         assert receiver_rank >= 0, f'invalid receiver {receiver}'
 
         # save key dataframe to temp file for streaming psi
         data_dir = tempfile.TemporaryDirectory()
-        input_path1, output_psi, output_peer, output_notsort = (
+        input_path1, output_psi, output_peer = (
             f'{data_dir.name}/psi-input.csv',
             f'{data_dir.name}/psi-output-join.csv',
             f'{data_dir.name}/psi-output-peer.csv',
-            f'{data_dir.name}/psi-output-nosort.csv',
         )
-        origin_table = pd.read_csv(input_path, usecols=key)
-        table_nodup = origin_table.drop_duplicates(subset=key)
 
-        table_nodup[key].to_csv(input_path1, index=False)
+        def read_origin_table():
+            # keys are only compared by psi, read them as text with the
+            # multi-threaded arrow parser. Types must be given up front, the
+            # text of inferred types (e.g. 007 or 1.50) is not kept.
+            return pa_csv.read_csv(
+                input_path,
+                convert_options=pa_csv.ConvertOptions(
+                    column_types={k: pa.string() for k in key},
+                    include_columns=key,
+                ),
+            ).to_pandas()
+
+        origin_table = read_origin_table()
+        origin_count = origin_table.shape[0]
+        duplicated = origin_table.duplicated(subset=key)
+        dup_count = int(duplicated.sum())
 
         logging.warning(
-            f"origin_table size:{origin_table.shape[0]},drop_duplicates size:{table_nodup.shape[0]}"
+            f"origin_table size:{origin_count},drop_duplicates size:{origin_count - dup_count}"
         )
 
-        # free table_nodup dataframe
-        del table_nodup
+        if dup_count > 0:
+            origin_table.loc[~duplicated, key].to_csv(input_path1, index=False)
+            psi_input_path = input_path1
+        else:
+            # keys are unique already, let psi read them from input directly.
+            psi_input_path = input_path
+        # release keys while running psi, they are read again for the join.
+        del duplicated, origin_table
 
         # psi join case, need sort and broadcast set True
         sort = True
@@ -843,7 +1045,7 @@ class SPURuntime:
             broadcast_result=broadcast_result,
             receiver_rank=receiver_rank,
             input_params=psi.InputParams(
-                path=input_path1, select_fields=key, precheck=precheck_input
+                path=psi_input_path, select_fields=key, precheck=precheck_input
             ),
             output_params=psi.OutputParams(path=output_psi, need_sort=sort),
             curve_type=curve_type,
@@ -851,23 +1053,38 @@ class SPURuntime:
         )
         report = psi.bucket_psi(self.link, config, ic_mode)
 
-        df_psi_out = pd.read_csv(output_psi)
-
-        join_rank = -1
-        for i, node in enumerate(self.cluster_def['nodes']):
-            if node['party'] == join_party:
-                join_rank = i
-                break
+        join_rank = self._party_to_rank.get(join_party, -1)
         assert join_rank >= 0, f'invalid receiver {join_party}'
 
         self_join = False
         if join_rank == self.rank:
             self_join = True
 
-        df_psi_join = origin_table.join(
-            df_psi_out.set_index(key), on=key, how='inner', sort="False"
-        )
-        df_psi_join[key].to_csv(output_psi, index=False)
+        origin_table = read_origin_table()
+        # keys of psi output are unique, so joining with it is just a filter
+        # of origin_table. Read the output in chunks as text like origin_table,
+        # so that keys compare equal, and mark the rows found in each chunk.
+        if len(key) == 1:
+            origin_keys = origin_table[key[0]]
+        else:
+            origin_keys = pd.MultiIndex.from_frame(origin_table[key])
+        psi_mask = np.zeros(len(origin_table), dtype=bool)
+        for psi_out_keys in pd.read_csv(
+            output_psi,
+            usecols=key,
+            dtype=str,
+            keep_default_na=False,
+            chunksize=1 << 20,
+            memory_map=True,
+        ):
+            if len(key) == 1:
+                psi_mask |= origin_keys.isin(psi_out_keys[key[0]]).to_numpy()
+            else:
+                psi_mask |= origin_keys.isin(
+                    pd.MultiIndex.from_frame(psi_out_keys[key])
+                )
+        del origin_keys
+        origin_table.loc[psi_mask, key].to_csv(output_psi, index=False)
 
         in_file_stats = os.stat(output_psi)
         in_file_bytes = in_file_stats.st_size
@@ -877,18 +1094,20 @@ class SPURuntime:
         out_file = open(output_peer, "wb")
 
         def send_proc():
-            max_read_bytes = 20480
+            max_read_bytes = self.psi_frame_max_payload_size
+            # frames are read into one buffer, header first and payload after.
+            frame = memoryview(bytearray(_PSI_FRAME_HEADER.size + max_read_bytes))
             read_bytes = 0
             while read_bytes < in_file_bytes:
                 current_read_bytes = min(max_read_bytes, in_file_bytes - read_bytes)
-                current_read = in_file.read(current_read_bytes)
-                assert current_read_bytes == len(
-                    current_read
-                ), f'invalid recv msg {current_read_bytes}!={len(current_read)}'
+                frame_size = _PSI_FRAME_HEADER.size + current_read_bytes
+                n = in_file.readinto(frame[_PSI_FRAME_HEADER.size : frame_size])
+                assert (
+                    current_read_bytes == n
+                ), f'invalid recv msg {current_read_bytes}!={n}'
 
-                packed_bytes = struct.pack(
-                    f'?i{len(current_read)}s', False, len(current_read), current_read
-                )
+                _PSI_FRAME_HEADER.pack_into(frame, 0, False, current_read_bytes)
+                packed_bytes = frame[:frame_size].tobytes()
 
                 read_bytes += current_read_bytes
 
@@ -896,7 +1115,7 @@ class SPURuntime:
                 logging.warning(f"rank:{self.rank} send {len(packed_bytes)}")
 
             # send last batch
-            packed_bytes = struct.pack('?is', True, 1, b'\x00')
+            packed_bytes = _PSI_LAST_FRAME
             self.link.send(self.link.next_rank(), packed_bytes)
             logging.warning(f"rank:{self.rank} send last {len(packed_bytes)}")
 
@@ -907,14 +1126,19 @@ class SPURuntime:
                 batch_count += 1
                 logging.warning(f"rank:{self.rank} recv {len(recv_bytes)}")
 
-                r1, r2, r3 = struct.unpack(f'?i{len(recv_bytes)-8}s', recv_bytes)
-                assert r2 == len(r3), f'invalid recv msg {r2}!={len(r3)}'
+                is_last, payload_size = _PSI_FRAME_HEADER.unpack_from(recv_bytes)
+                payload = memoryview(recv_bytes)[_PSI_FRAME_HEADER.size :]
+                assert payload_size == len(
+                    payload
+                ), f'invalid recv msg {payload_size}!={len(payload)}'
                 # check if last batch
-                if r1:
+                if is_last:
                     logging.warning(f"rank:{self.rank} recv last {len(recv_bytes)}")
                     break
-                out_file.write(r3)
+                out_file.write(payload)
 
+        # NOTE: send and recv must not run concurrently, the link assigns p2p
+        # message ids for both of them from one context.
         if self.rank == 1:
             send_proc()
             recv_proc()
@@ -929,51 +1153,105 @@ class SPURuntime:
         out_file_bytes = out_file_stats.st_size
 
         table_head = pd.read_csv(input_path, nrows=0)
-        table_head.to_csv(output_path, index=False)
-        table_head.to_csv(output_notsort, index=False)
-        table_columns = table_head.columns.str.replace(' ', '')
+        table_columns = table_head.columns
+        key_fields = table_columns.get_indexer(key)
+        assert (key_fields >= 0).all(), f'key {key} not in columns of {input_path}'
 
+        join_count = 0
+        run_paths = []
         # check psi result file size
         if out_file_bytes > 0:
-            peer_psi = pd.read_csv(output_peer)
+            # keys are joined as text like psi compares them.
+            peer_psi = pd.read_csv(
+                output_peer, dtype=str, keep_default_na=False, memory_map=True
+            )
             peer_psi.columns = key
-
-            join_count = 0
-            chunk_size = 100000
-            reader = pd.read_csv(input_path, chunksize=chunk_size)
-            for chunk in reader:
-                if self_join:
-                    chunk_join = chunk.join(
-                        peer_psi.set_index(key), on=key, how='inner', sort="True"
-                    )
+            # keys of peer may repeat, so this is a many-to-many join rather
+            # than a filter: every matched row of chunk is repeated by the count
+            # of its key in peer. Count peer keys only once for all chunks.
+            peer_key_counts = peer_psi.groupby(key, dropna=False).size()
+            del peer_psi
+            # the hash table of an index is built lazily on first lookup, for
+            # multiple keys without holding the GIL. Build it before chunks are
+            # joined concurrently, so that no thread reads a partial one.
+            peer_key_counts.index.is_unique
+
+            def join_chunk(chunk: pd.DataFrame, run_path: str) -> int:
+                if len(key) == 1:
+                    chunk_keys = pd.Index(chunk[key[0]])
                 else:
-                    chunk_join = peer_psi.join(
-                        chunk.set_index(key), on=key, how='inner', sort="True"
+                    chunk_keys = pd.MultiIndex.from_frame(chunk[key])
+                repeats = peer_key_counts.reindex(chunk_keys, fill_value=0).to_numpy()
+                positions = np.repeat(np.arange(chunk.shape[0]), repeats)
+                if not self_join:
+                    # peer joins the rows of chunk once per peer row, i.e. the
+                    # matched rows of a key are tiled rather than repeated
+                    # one by one. Only the order within a key matters, as
+                    # lines of csv are sorted by key below.
+                    tile = np.arange(positions.shape[0]) - np.repeat(
+                        np.cumsum(repeats) - repeats, repeats
                     )
-                join_count = join_count + chunk_join.shape[0]
+                    positions = positions[np.argsort(tile, kind='stable')]
+                chunk_join = chunk.iloc[positions]
                 chunk_join.to_csv(
-                    output_notsort,
-                    mode="a",
-                    index=False,
-                    header=False,
-                    columns=table_columns,
+                    run_path, index=False, header=False, columns=table_columns
                 )
+                return chunk_join.shape[0]
+
+            # join chunks concurrently while bounding the chunks held in memory.
+            # every chunk is joined into its own file, files are sorted in the
+            # order of chunks below, so the sort stays stable.
+            max_workers = min(_PSI_JOIN_MAX_WORKERS, os.cpu_count() or 1)
+            chunk_size = 100000
+            # parse straight from the page cache, the file is read only once.
+            reader = pd.read_csv(
+                input_path,
+                dtype={k: str for k in key},
+                keep_default_na=False,
+                chunksize=chunk_size,
+                memory_map=True,
+            )
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                pending = collections.deque()
+                for chunk in reader:
+                    run_path = f'{data_dir.name}/psi-output-run-{len(run_paths)}.csv'
+                    run_paths.append(run_path)
+                    pending.append(executor.submit(join_chunk, chunk, run_path))
+                    if len(pending) >= 2 * max_workers:
+                        join_count += pending.popleft().result()
+                while pending:
+                    join_count += pending.popleft().result()
 
         logging.warning(
             f"intersection_count:{report.intersection_count} join_count:{join_count}"
         )
 
-        idlist = []
-        for ele in key:
-            pos_str = str(table_columns.get_loc(ele) + 1)
-            idlist.append(f"--key={pos_str},{pos_str}")
-        idstr = ' '.join(idlist)
-        sort_cmd = f'tail -n +2 {output_notsort} | LC_ALL=C sort --buffer-size=2G --parallel=8 --temporary-directory=./ --stable --field-separator=, {idstr} >>{output_path}'
-        logging.info(f"sort_cmd:{sort_cmd}")
-        sp_ret = subprocess.run(sort_cmd, shell=True)
-        assert (
-            sp_ret.returncode == 0
-        ), f"sort cmd failed, return {sp_ret.returncode}, expected 0"
+        with open(output_path, 'wb') as out_file:
+            table_head.to_csv(out_file, index=False)
+            if run_paths:
+                # sort reads the joined files one after another, as if they were
+                # concatenated, and writes lines sorted by key after the header.
+                run_list = f'{data_dir.name}/psi-output-runs'
+                with open(run_list, 'w') as f:
+                    f.write(''.join(f'{run_path}\0' for run_path in run_paths))
+                sort_cmd = [
+                    'sort',
+                    '--buffer-size=2G',
+                    '--parallel=8',
+                    f'--temporary-directory={data_dir.name}',
+                    '--stable',
+                    '--field-separator=,',
+                    *[f'--key={i + 1},{i + 1}' for i in key_fields],
+                    f'--files0-from={run_list}',
+                ]
+                logging.info(f"sort_cmd:{' '.join(sort_cmd)}")
+                out_file.flush()
+                sp_ret = subprocess.run(
+                    sort_cmd, stdout=out_file, env={**os.environ, 'LC_ALL': 'C'}
+                )
+                assert (
+                    sp_ret.returncode == 0
+                ), f"sort cmd failed, return {sp_ret.returncode}, expected 0"
 
         # delete tmp data dir
         data_dir.cleanup()
@@ -982,7 +1260,7 @@ class SPURuntime:
 
         return {
             'party': party,
-            'original_count': origin_table.shape[0],
+            'original_count': origin_count,
             'intersection_count': report.intersection_count,
             'join_count': join_count,
         }
@@ -1022,11 +1300,7 @@ class SPURuntime:
             label_columns = [label_columns]
 
         party = self.cluster_def['nodes'][self.rank]['party']
-        server_rank = -1
-        for i, node in enumerate(self.cluster_def['nodes']):
-            if node['party'] == server:
-                server_rank = i
-                break
+        server_rank = self._party_to_rank.get(server, -1)
         assert server_rank >= 0, f'invalid server: {server}'
         if server_rank != self.rank:
             return {
@@ -1107,11 +1381,7 @@ class SPURuntime:
         ]
 
         party = self.cluster_def['nodes'][self.rank]['party']
-        server_rank = -1
-        for i, node in enumerate(self.cluster_def['nodes']):
-            if node['party'] == server:
-                server_rank = i
-                break
+        server_rank = self._party_to_rank.get(server, -1)
         assert server_rank >= 0, f'invalid server: {server}'
 
         if self.rank == server_rank:
@@ -1132,9 +1402,8 @@ class SPURuntime:
                         f'param {name} must in pir server config'
                     )
 
-            packed_bytes = struct.pack('?is', True, 1, b'\x00')
-            self.link.send(self.link.next_rank(), packed_bytes)
-            logging.info(f"rank:{self.rank} send {len(packed_bytes)} sync status")
+            self.link.send(self.link.next_rank(), _PIR_SYNC_PACKET)
+            logging.info(f"rank:{self.rank} send {len(_PIR_SYNC_PACKET)} sync status")
 
             config = pir.PirServerConfig(
                 pir_protocol=pir.PirProtocol.Value(protocol),
@@ -1199,28 +1468,27 @@ def _argnames_partial_except(fn, static_argnames, kwargs):
 
 
 def _generate_input_uuid():
-    return f'input-{uuid.uuid4()}'
+    return 'input-' + uuid.uuid4().hex
 
 
 def _generate_output_uuid():
-    return f'output-{uuid.uuid4()}'
+    return 'output-' + uuid.uuid4().hex
 
 
 def _spu_compile(fn, *meta_args, **meta_kwargs):
-    meta_args, meta_kwargs = jax.tree_util.tree_map(
-        lambda x: ray.get(x) if isinstance(x, ray.ObjectRef) else x,
-        (meta_args, meta_kwargs),
-    )
+    metas = jax.tree_util.tree_leaves((meta_args, meta_kwargs))
+    # metas are usually passed by value already, only walk the tree again to
+    # fetch them if some are still object refs.
+    if any(isinstance(x, ray.ObjectRef) for x in metas):
+        meta_args, meta_kwargs = jax.tree_util.tree_map(
+            lambda x: ray.get(x) if isinstance(x, ray.ObjectRef) else x,
+            (meta_args, meta_kwargs),
+        )
+        metas = jax.tree_util.tree_leaves((meta_args, meta_kwargs))
 
     # prepare inputs and metatdata.
-    input_name = []
-    input_vis = []
-
-    def _get_input_metatdata(obj: SPUObject):
-        input_name.append(_generate_input_uuid())
-        input_vis.append(obj.vtype)
-
-    jax.tree_util.tree_map(_get_input_metatdata, (meta_args, meta_kwargs))
+    input_name = [_generate_input_uuid() for _ in metas]
+    input_vis = [meta.vtype for meta in metas]
 
     try:
         executable, output_tree = spu_fe.compile(
@@ -1338,14 +1606,16 @@ class SPU(Device):
         self.cluster_def['nodes'].sort(key=lambda x: x['party'])
         self.link_desc = link_desc
         self.log_options = log_options
-        self.conf = json_format.Parse(
-            json.dumps(cluster_def['runtime_config']), spu.RuntimeConfig()
+        self.conf = json_format.ParseDict(
+            cluster_def['runtime_config'], spu.RuntimeConfig()
         )
         self.world_size = len(self.cluster_def['nodes'])
         self.actors = {}
         self._task_id = -1
         self.io = SPUIO(self.conf, self.world_size)
         self.use_link = use_link
+        # shares_name of released SPUObjects, pending for deletion.
+        self._del_queue = collections.deque()
         self.init()
 
     def init(self):
@@ -1362,6 +1632,8 @@ class SPU(Device):
                     self.use_link,
                 )
             )
+        # actors in rank order, saves building a view of self.actors per call.
+        self._actor_values = tuple(self.actors.values())
 
     def reset(self):
         """Reset spu to clear corrupted internal state, for test only"""
@@ -1370,9 +1642,49 @@ class SPU(Device):
         self.init()
 
     def shutdown(self):
+        self.flush_del_shares()
         for actor in self.actors.values():
             sfd.kill(actor)
 
+    def del_shares(self, shares_name: List[Union[ray.ObjectRef, fed.FedObject]]):
+        """Release shares of an SPUObject.
+
+        Shares are queued and deleted by one remote call per actor, which
+        avoids flooding actors with tiny RPCs when lots of SPUObjects are
+        released. The queue is flushed once `_DEL_SHARES_BATCH_SIZE` objects
+        are pending, when the SPU runs a function, when shares are fetched
+        from the SPU and on shutdown. All of them happen at the same point
+        of the program in every party, so in production mode the remote
+        calls of all parties stay in the same order.
+
+        Args:
+            shares_name: shares_name of an SPUObject.
+        """
+        self._del_queue.append(shares_name)
+        if len(self._del_queue) >= _DEL_SHARES_BATCH_SIZE:
+            self.flush_del_shares()
+
+    def flush_del_shares(self):
+        """Delete all pending shares immediately."""
+        pending = []
+        while True:
+            # deque.popleft is atomic, __del__ may append concurrently.
+            try:
+                pending.append(self._del_queue.popleft())
+            except IndexError:
+                break
+        if not pending:
+            return
+
+        for i, actor in enumerate(self.actors.values()):
+            try:
+                actor.del_shares.remote(*[names[i] for names in pending])
+            except TypeError:
+                # Python doesn't make any guarantees about when __del__ is called,
+                # actor may not exist, been GCed before this function called.
+                # This may happened when Host(Driver) progress exit.
+                pass
+
     def _place_arguments(self, *args, **kwargs):
         def place(obj):
             if isinstance(obj, DeviceObject):
@@ -1382,9 +1694,10 @@ class SPU(Device):
                 # host program, so it's safe to mark it as VIS_PUBLIC.
                 meta, *refs = self.io.make_shares(obj, spu.Visibility.VIS_PUBLIC)
 
-                shares_name = []
-                for i, actor in enumerate(self.actors.values()):
-                    shares_name.append(actor.infeed_share.remote(refs[i]))
+                shares_name = [
+                    actor.infeed_share.remote(ref)
+                    for actor, ref in zip(self._actor_values, refs)
+                ]
 
                 return SPUObject(self, meta, shares_name)
 
@@ -1396,11 +1709,10 @@ class SPU(Device):
             actor.dump.remote(obj.meta, obj.shares_name[i], paths[i])
 
     def load(self, paths: List[str]) -> SPUObject:
-        outputs = [None] * self.world_size
-        for i, actor in enumerate(self.actors.values()):
-            actor_out = actor.load.options(num_returns=2).remote(paths[i])
-
-            outputs[i] = actor_out
+        outputs = [
+            actor.load.options(num_returns=2).remote(path)
+            for actor, path in zip(self._actor_values, paths)
+        ]
 
         return SPUObject(
             self, outputs[0][0], [outputs[i][1] for i in range(self.world_size)]
@@ -1415,14 +1727,20 @@ class SPU(Device):
         user_specified_num_returns: int = 1,
     ):
         def wrapper(*args, **kwargs):
+            # release shares of dead SPUObjects before allocating new ones.
+            self.flush_del_shares()
+
             # handle static_argnames of func
             fn, kwargs = _argnames_partial_except(func, static_argnames, kwargs)
 
             # convert every args to SPU objects.
             args, kwargs = self._place_arguments(*args, **kwargs)
 
-            (meta_args, meta_kwargs) = jax.tree_util.tree_map(
-                lambda x: x.meta if isinstance(x, SPUObject) else x, (args, kwargs)
+            # every leaf of args is an SPUObject now, flatten them only once
+            # for both metas and shares.
+            arg_objs, arg_tree = jax.tree_util.tree_flatten((args, kwargs))
+            (meta_args, meta_kwargs) = arg_tree.unflatten(
+                [obj.meta for obj in arg_objs]
             )
 
             num_returns = user_specified_num_returns
@@ -1450,19 +1768,15 @@ class SPU(Device):
                 num_returns = 1
 
             # run executable and get returns.
-            outputs = [None] * self.world_size
-            for i, actor in enumerate(self.actors.values()):
-                (actor_args, actor_kwargs) = jax.tree_util.tree_map(
-                    lambda x: x.shares_name[i], (args, kwargs)
+            outputs = [
+                actor.run.options(num_returns=2 * num_returns).remote(
+                    num_returns_policy,
+                    out_shape,
+                    executable,
+                    *[obj.shares_name[i] for obj in arg_objs],
                 )
-
-                val, _ = jax.tree_util.tree_flatten((actor_args, actor_kwargs))
-
-                actor_out = actor.run.options(num_returns=2 * num_returns).remote(
-                    num_returns_policy, out_shape, executable, *val
-                )
-
-                outputs[i] = actor_out
+                for i, actor in enumerate(self._actor_values)
+            ]
 
             if num_returns_policy == SPUCompilerNumReturnsPolicy.SINGLE:
                 return SPUObject(self, outputs[0][0], [output[1] for output in outputs])
@@ -1482,8 +1796,8 @@ class SPU(Device):
                     else:
                         return all_atomic_spu_objects
 
-                _, out_tree = jax.tree_util.tree_flatten(out_shape)
-                return jax.tree_util.tree_unflatten(out_tree, all_atomic_spu_objects)
+                out_tree = jax.tree_util.tree_structure(out_shape)
+                return out_tree.unflatten(all_atomic_spu_objects)
 
         return wrapper
 
@@ -1492,22 +1806,22 @@ class SPU(Device):
     ) -> List[Union[ray.ObjectRef, fed.FedObject]]:
         assert len(shares) == len(self.actors)
 
-        ret = []
-        for i, actor in enumerate(self.actors.values()):
-            ret.append(actor.infeed_share.remote(shares[i]))
-
-        return ret
+        return [
+            actor.infeed_share.remote(share)
+            for actor, share in zip(self._actor_values, shares)
+        ]
 
     def outfeed_shares(
         self, shares_name: List[Union[ray.ObjectRef, fed.FedObject]]
     ) -> List[Union[ray.ObjectRef, fed.FedObject]]:
         assert len(shares_name) == len(self.actors)
+        # release shares of dead SPUObjects before fetching, e.g. by reveal.
+        self.flush_del_shares()
 
-        ret = []
-        for i, actor in enumerate(self.actors.values()):
-            ret.append(actor.outfeed_share.remote(shares_name[i]))
-
-        return ret
+        return [
+            actor.outfeed_share.remote(share_name)
+            for actor, share_name in zip(self._actor_values, shares_name)
+        ]
 
     def psi_df(
         self,
@@ -44,22 +44,21 @@ class BigintNdArray:
         self.shape = shape
         self.data = data
 
+    @classmethod
+    def from_ndarray(cls, arr: np.ndarray):
+        """Build from a numpy array of integers (or python ints with dtype object)."""
+        return cls(arr.reshape(-1).tolist(), arr.shape)
+
     def resize(self, shape):
         assert math.prod(shape) == math.prod(
             self.shape
         ), f"cannot resize array of size {self.shape} into shape {shape}"
         self.shape = shape
 
-    def __to_list(self, dim, idx):  # idx is a list just to make it pass by ref
-        if dim == len(self.shape) - 1:
-            dim_res = self.data[idx[0] : idx[0] + self.shape[dim]]
-            idx[0] += self.shape[dim]
-            return dim_res
-        else:
-            return [self.__to_list(dim + 1, idx) for _ in range(self.shape[dim])]
-
     def to_list(self):
-        return self.__to_list(0, [0])
+        # reshape an object array rather than slicing self.data recursively,
+        # the nested lists are then built by numpy in one pass.
+        return np.array(self.data, dtype=object).reshape(tuple(self.shape)).tolist()
 
     def to_numpy(self):
         return np.array(self.to_list())
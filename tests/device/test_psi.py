@@ -608,3 +608,51 @@ def test_psi_join_csv(prod_env_and_model):
         pd.testing.assert_frame_equal(
             sf.reveal(devices.bob(pd.read_csv)(output_path[devices.bob])), result_b
         )
+
+
+def test_psi_join_csv_zero_padded_keys(prod_env_and_model):
+    devices, _ = prod_env_and_model
+
+    def write_text(text, save_path):
+        with open(save_path, 'w') as f:
+            f.write(text)
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        input_path = {
+            devices.alice: f'{data_dir}/alice.csv',
+            devices.bob: f'{data_dir}/bob.csv',
+        }
+        output_path = {
+            devices.alice: f'{data_dir}/alice_psi.csv',
+            devices.bob: f'{data_dir}/bob_psi.csv',
+        }
+
+        # keys of alice repeat while keys of bob are unique.
+        sf.reveal(
+            devices.alice(write_text)(
+                'id,item\n010,A\n007,B\n008,C\n007,D\n', input_path[devices.alice]
+            )
+        )
+        sf.reveal(
+            devices.bob(write_text)(
+                'id,feature\n007,X\n011,Y\n010,Z\n', input_path[devices.bob]
+            )
+        )
+
+        devices.spu.psi_join_csv('id', input_path, output_path, 'alice', 'alice')
+
+        result_a = pd.DataFrame({'id': ['007', '007', '010'], 'item': ['B', 'D', 'A']})
+        result_b = pd.DataFrame(
+            {'id': ['007', '007', '010'], 'feature': ['X', 'X', 'Z']}
+        )
+
+        pd.testing.assert_frame_equal(
+            sf.reveal(
+                devices.alice(pd.read_csv)(output_path[devices.alice], dtype=str)
+            ),
+            result_a,
+        )
+        pd.testing.assert_frame_equal(
+            sf.reveal(devices.bob(pd.read_csv)(output_path[devices.bob], dtype=str)),
+            result_b,
+        )
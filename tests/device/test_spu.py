@@ -1,12 +1,20 @@
+import random
+import sys
 import tempfile
 
 import jax
 import numpy as np
+import pytest
 from jax.example_libraries import optimizers, stax
 from jax.example_libraries.stax import Dense, Relu
 
 import secretflow as sf
-from secretflow.device.device.spu import SPUObject
+import secretflow.distributed as sfd
+from secretflow.device.device.spu import (
+    _DEL_SHARES_BATCH_SIZE,
+    SPUObject,
+    _fxp_content_to_ndarray,
+)
 
 
 def MLP():
@@ -147,3 +155,47 @@ def test_dump_load_prod(sf_production_setup_devices):
 
 def test_dump_load_sim(sf_simulation_setup_devices):
     _test_dump_load(sf_simulation_setup_devices)
+
+
+@pytest.mark.parametrize('size', [4, 8, 16, 3, 12])
+def test_fxp_content_to_ndarray(size):
+    rng = random.Random(0)
+    bound = 1 << (size * 8 - 1)
+    values = [rng.getrandbits(size * 8) - bound for _ in range(100)]
+    values += [-bound, -1, 0, 1, bound - 1]
+    content = b''.join(v.to_bytes(size, sys.byteorder, signed=True) for v in values)
+
+    assert _fxp_content_to_ndarray(content, size).tolist() == values
+    assert _fxp_content_to_ndarray(b'', size).shape == (0,)
+
+
+def test_del_shares_prod(sf_production_setup_devices):
+    devices = sf_production_setup_devices
+    devices.spu.flush_del_shares()
+    xs = [
+        devices.alice(lambda: np.arange(4))().to(devices.spu)
+        for _ in range(_DEL_SHARES_BATCH_SIZE + 1)
+    ]
+
+    del xs
+    # a full batch is deleted at once, the rest waits for the next spu call.
+    assert len(devices.spu._del_queue) == 1
+    y = devices.spu(lambda a: a + 1)(devices.alice(lambda: 1)())
+    assert sf.reveal(y) == 2
+
+
+def test_del_shares_sim(sf_simulation_setup_devices):
+    devices = sf_simulation_setup_devices
+    x = devices.alice(lambda: np.arange(4))().to(devices.spu)
+    shares_name = x.shares_name
+    # shares_name is in the order of spu actors.
+    actor = list(devices.spu.actors.values())[0]
+    np.testing.assert_equal(sf.reveal(x), np.arange(4))
+
+    del x
+    # running any function on spu deletes pending shares.
+    y = devices.spu(lambda a: a + 1)(devices.alice(lambda: 1)())
+    assert sf.reveal(y) == 2
+
+    with pytest.raises(Exception):
+        sfd.get(actor.outfeed_share.remote(shares_name[0]))
@@ -38,6 +38,18 @@ def test_add():
     assert (array_sum.to_numpy() == np_array_sum).all()
 
 
+def test_from_ndarray():
+    data = np.arange(-12, 12, dtype=np.int64).reshape((2, 3, 4))
+    a = ndarray_bigint.BigintNdArray.from_ndarray(data)
+    assert a.shape == (2, 3, 4)
+    assert all(isinstance(i, int) for i in a.data)
+    assert (a.to_numpy() == data).all()
+
+    big = np.array([1 << 100, -(1 << 100)], dtype=object)
+    a = ndarray_bigint.BigintNdArray.from_ndarray(big)
+    assert a.data == [1 << 100, -(1 << 100)]
+
+
 def test_to_bytes():
     array = ndarray_bigint.arange(300)
     b1 = array.to_bytes(1)